@@ -1,16 +1,23 @@
 import os
-import json
+import re
+import orjson
+import asyncio
+import inspect
+import logging
+from functools import lru_cache
 from typing import Annotated, TypedDict
 from dotenv import load_dotenv
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_core.messages import SystemMessage, ToolMessage
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
 from langchain_core.tools import tool
+from langchain_core.runnables import RunnableLambda
 
 from langgraph.graph import StateGraph, START, END
 from langgraph.graph.message import add_messages
 from langgraph.checkpoint.memory import MemorySaver
 
 load_dotenv()
+logger = logging.getLogger(__name__)
 
 # --- 1. SETUP & DATABASES ---
 llm = ChatGoogleGenerativeAI(
@@ -19,16 +26,62 @@ llm = ChatGoogleGenerativeAI(
     google_api_key=os.getenv("GOOGLE_API_KEY")
 )
 
+# Cheaper, faster model for routine turns (short answers, naming an item, reading back tool results).
+# The model name travels with each request, so the lite handle is a copy of llm that shares its google-genai client
+# and keep-alive connection pool instead of building its own TLS connections to generativelanguage.googleapis.com
+# (the constructor always builds a fresh client, even when one is passed in).
+llm_lite = llm.model_copy(update={"model": "gemini-2.5-flash-lite"})
+
 # Load the hierarchical JSON menu from the file
 try:
-    with open("menu.json", "r") as f:
-        MENU_DATA = json.load(f)
+    with open("menu.json", "rb") as f:
+        MENU_DATA = orjson.loads(f.read())
         MENU_ITEMS = MENU_DATA.get("menu_items", [])
 except FileNotFoundError:
-    print("WARNING: menu.json not found. Make sure it is in the same directory.")
+    logger.warning("menu.json not found. Make sure it is in the same directory.")
     MENU_ITEMS = []
 
 
+# Build the search index once at import: every prefix of every word -> indices into MENU_ITEMS (a flattened trie,
+# so "pep" -> Pepperoni is one dict lookup), plus the pre-formatted result line per item
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str) -> list:
+    return TOKEN_RE.findall(text.lower())
+
+
+MENU_INDEX = {}
+MENU_LINES = []
+# variant_id -> (item name, variant name, price), so add_to_cart resolves an ID with one dict lookup
+VARIANT_INDEX = {}
+for idx, item in enumerate(MENU_ITEMS):
+    searchable_text = f"{item['name']} {item['description']} {' '.join(item.get('tags', []))} {' '.join(item.get('allergens', []))}"
+    for token in tokenize(searchable_text):
+        for end in range(1, len(token) + 1):
+            MENU_INDEX.setdefault(token[:end], set()).add(idx)
+
+    # Format the variants so the LLM knows the prices and exact variant_ids to use
+    variants_str = " | ".join([f"{v['name']} (ID: {v['variant_id']}, ${v['price']})" for v in item['variants']])
+    veg = "Vegetarian" if item.get("is_vegetarian") else "Not Vegetarian"
+    spice = item.get("spice_level", "none")
+    MENU_LINES.append(f"- {item['name']} ({veg}, Spice: {spice}): {item['description']} -> Options: [{variants_str}]")
+
+    for v in item["variants"]:
+        VARIANT_INDEX[v["variant_id"]] = (item["name"], v["name"], v["price"])
+
+
+def find_menu_items(query: str) -> list:
+    """Returns MENU_ITEMS indices where every query word prefixes some word of the item, in menu order."""
+    hits = None
+    for word in tokenize(query):
+        word_hits = MENU_INDEX.get(word, set())
+        hits = word_hits if hits is None else hits & word_hits
+        if not hits:
+            return []
+    return sorted(hits) if hits else []
+
+
 class AgentState(TypedDict):
     messages: Annotated[list, add_messages]
     cart: list
@@ -55,7 +108,9 @@ def request_human_handoff(reason: str):
     pass
 
 
-llm_with_tools = llm.bind_tools([search_menu, add_to_cart, request_human_handoff])
+TOOLS = [search_menu, add_to_cart, request_human_handoff]
+llm_with_tools = llm.bind_tools(TOOLS)
+llm_lite_with_tools = llm_lite.bind_tools(TOOLS)
 
 SYSTEM_PROMPT = """You are DineLine, an AI phone ordering assistant.
 Rules:
@@ -68,102 +123,223 @@ Rules:
 7. When they are finally done, tell them their total and say "Goodbye".
 """
 
+# Built once so every request opens with a byte-identical prefix that Gemini's implicit prompt cache can reuse
+SYSTEM_MESSAGE = SystemMessage(content=SYSTEM_PROMPT)
+
+
+# Long calls only send Gemini their recent history: at least HISTORY_WINDOW messages, with old ones dropped
+# HISTORY_TRIM_STEP at a time. Trimming in blocks keeps the prompt prefix identical between cuts so Gemini's
+# implicit cache keeps hitting; a window that slid every turn would change the prefix on every request.
+# The cart travels separately in build_prompt, so old turns can be dropped without losing the order.
+HISTORY_WINDOW = 16
+HISTORY_TRIM_STEP = 8
+
+
+def summarize_cart(cart: list, order_total: float) -> str:
+    """One line with names and quantities only; the LLM never needs ids or unit prices since it must not do math."""
+    items = ", ".join(f"{line['quantity']}x {line['name']}" for line in cart) or "empty"
+    return f"Cart: {items}. Total ${order_total:.2f}."
+
+
+def build_prompt(state: AgentState) -> list:
+    messages = state["messages"]
+    cut = (len(messages) - HISTORY_WINDOW) // HISTORY_TRIM_STEP * HISTORY_TRIM_STEP
+    if cut > 0:
+        messages = messages[cut:]
+        # Start the window on a customer turn so it never opens with a tool result whose call was cut off
+        start = next((i for i, m in enumerate(messages) if isinstance(m, HumanMessage)), 0)
+        messages = messages[start:]
+
+    # The cart goes in as a second system message, right after the static prompt, so the model never mistakes it for
+    # something the customer said. Gemini folds both into its system instruction.
+    cart_context = SystemMessage(content=summarize_cart(state.get("cart", []), state.get("order_total", 0.0)))
+    return [SYSTEM_MESSAGE, cart_context] + messages
+
+
+# Wrapping up the order (reading back the total, saying goodbye) and long or rambling speech go to the full model
+FINISH_RE = re.compile(r"\b(that'?s (all|it)|i'?m (done|finished)|nothing else|no thanks|bye|goodbye)\b")
+LITE_MAX_WORDS = 8
+
+
+def pick_llm(messages: list):
+    last = messages[-1] if messages else None
+    if isinstance(last, ToolMessage):
+        return llm_lite_with_tools
+    if isinstance(last, HumanMessage):
+        text = str(last.content).lower()
+        if len(text.split()) <= LITE_MAX_WORDS and not FINISH_RE.search(text):
+            return llm_lite_with_tools
+    return llm_with_tools
+
 
 def call_model(state: AgentState):
-    cart_context = f"\n\nCurrent Cart: {state.get('cart', [])}\nTotal: ${state.get('order_total', 0.0)}"
-    sys_msg = SystemMessage(content=SYSTEM_PROMPT + cart_context)
-    response = llm_with_tools.invoke([sys_msg] + state["messages"])
+    response = pick_llm(state["messages"]).invoke(build_prompt(state))
     return {"messages": response}
 
 
-def execute_tools(state: AgentState):
-    last_message = state["messages"][-1]
+async def acall_model(state: AgentState):
+    # Awaiting Gemini keeps the server's event loop free for other calls while this one waits on the LLM
+    response = await pick_llm(state["messages"]).ainvoke(build_prompt(state))
+    return {"messages": response}
+
+
+# Each handler takes the tool_call and returns (ToolMessage, cart line or None, handoff requested). Handlers never touch
+# the shared cart, so a turn's calls can run concurrently and be folded together afterwards in call order.
+def handle_handoff(tool_call):
+    return ToolMessage(content="System: Handoff initiated.", tool_call_id=tool_call["id"]), None, True
+
+
+# The menu is fixed for the life of the process, so repeat searches ("pepperoni", "coke") are served from memory.
+# Call search_menu_reply.cache_clear() if the menu is ever reloaded.
+@lru_cache(maxsize=512)
+def search_menu_reply(query: str) -> str:
+    results = [MENU_LINES[idx] for idx in find_menu_items(query)]
+    return "System: Available items:\n" + "\n".join(
+        results) if results else f"System: No items found matching '{query}'."
+
+
+def handle_search_menu(tool_call):
+    # Normalize case and whitespace so "Pepperoni " and "pepperoni" share one cache entry
+    reply = search_menu_reply(" ".join(tool_call["args"]["query"].lower().split()))
+    return ToolMessage(content=reply, tool_call_id=tool_call["id"]), None, False
+
+
+def handle_add_to_cart(tool_call):
+    variant_id = tool_call["args"]["variant_id"]
+    qty = tool_call["args"]["quantity"]
+
+    entry = VARIANT_INDEX.get(variant_id)
+    if not entry:
+        msg = ToolMessage(
+            content=f"Error: Invalid variant_id '{variant_id}'. You must search the menu first to find the correct ID.",
+            tool_call_id=tool_call["id"], status="error")
+        return msg, None, False
+    found_item_name, variant_name, unit_price = entry
+
+    # Calculate and structure the POS payload
+    line_total = unit_price * qty
+    line = {
+        "variant_id": variant_id,
+        "name": f"{found_item_name} - {variant_name}",
+        "quantity": qty,
+        "unit_price": unit_price,
+        "line_total": line_total
+    }
+    msg = ToolMessage(content=f"Added {qty} {found_item_name} ({variant_name}). Line total: ${line_total}",
+                      tool_call_id=tool_call["id"])
+    return msg, line, False
+
+
+def handle_unknown_tool(tool_call):
+    # Gemini expects a response for every call it made, even one we can't run
+    msg = ToolMessage(content=f"Error: Unknown tool '{tool_call['name']}'.", tool_call_id=tool_call["id"],
+                      status="error")
+    return msg, None, False
+
+
+TOOL_HANDLERS = {
+    "search_menu": handle_search_menu,
+    "add_to_cart": handle_add_to_cart,
+    "request_human_handoff": handle_handoff,
+}
+
+# Tools whose result can be read back to the caller without another LLM call
+TEMPLATED_TOOLS = {"add_to_cart", "request_human_handoff"}
+
+
+def fold_tool_results(state: AgentState, results: list):
     cart = list(state.get("cart", []))
     order_total = state.get("order_total", 0.0)
     requires_handoff = state.get("requires_handoff", False)
     tool_messages = []
 
-    for tool_call in last_message.tool_calls:
-        if tool_call["name"] == "request_human_handoff":
-            requires_handoff = True
-            tool_messages.append(ToolMessage(content="System: Handoff initiated.", tool_call_id=tool_call["id"]))
-
-        elif tool_call["name"] == "search_menu":
-            query = tool_call["args"]["query"].lower()
-            results = []
-
-            # Search through the nested JSON structure
-            for item in MENU_ITEMS:
-                # Create a searchable string combining all relevant fields
-                searchable_text = f"{item['name']} {item['description']} {' '.join(item.get('tags', []))} {' '.join(item.get('allergens', []))}".lower()
-
-                if query in searchable_text:
-                    # Format the variants so the LLM knows the prices and exact variant_ids to use
-                    variants_str = " | ".join(
-                        [f"{v['name']} (ID: {v['variant_id']}, ${v['price']})" for v in item['variants']])
-                    veg = "Vegetarian" if item.get("is_vegetarian") else "Not Vegetarian"
-                    spice = item.get("spice_level", "none")
-
-                    results.append(
-                        f"- {item['name']} ({veg}, Spice: {spice}): {item['description']} -> Options: [{variants_str}]")
-
-            reply = "System: Available items:\n" + "\n".join(
-                results) if results else f"System: No items found matching '{query}'."
-            tool_messages.append(ToolMessage(content=reply, tool_call_id=tool_call["id"]))
-
-        elif tool_call["name"] == "add_to_cart":
-            variant_id = tool_call["args"]["variant_id"]
-            qty = tool_call["args"]["quantity"]
-
-            # Deep search to find the specific variant across all menu items
-            found_variant = None
-            found_item_name = None
-
-            for item in MENU_ITEMS:
-                for var in item["variants"]:
-                    if var["variant_id"] == variant_id:
-                        found_variant = var
-                        found_item_name = item["name"]
-                        break
-                if found_variant:
-                    break
-
-            if not found_variant:
-                tool_messages.append(
-                    ToolMessage(
-                        content=f"Error: Invalid variant_id '{variant_id}'. You must search the menu first to find the correct ID.",
-                        tool_call_id=tool_call["id"]))
-                continue
-
-            # Calculate and structure the POS payload
-            line_total = found_variant["price"] * qty
-            cart.append({
-                "variant_id": variant_id,
-                "name": f"{found_item_name} - {found_variant['name']}",
-                "quantity": qty,
-                "unit_price": found_variant["price"],
-                "line_total": line_total
-            })
-            order_total += line_total
-            tool_messages.append(
-                ToolMessage(content=f"Added {qty} {found_item_name} ({found_variant['name']}). Total: ${order_total}",
-                            tool_call_id=tool_call["id"]))
+    for msg, line, handoff in results:
+        tool_messages.append(msg)
+        if line:
+            cart.append(line)
+            order_total += line["line_total"]
+        requires_handoff = requires_handoff or handoff
+
+    # Successful adds and handoffs have a fixed reply, so answer here instead of paying for another Gemini call
+    if all(tc["name"] in TEMPLATED_TOOLS for tc in state["messages"][-1].tool_calls) and \
+            all(m.status == "success" for m in tool_messages):
+        if requires_handoff:
+            reply = "Connecting you to staff."
+        else:
+            added = ", ".join(f"{line['quantity']} {line['name']}" for line in cart[len(state.get("cart", [])):])
+            reply = f"Added {added}. Your total is ${order_total:.2f}. Anything else?"
+        tool_messages.append(AIMessage(content=reply))
 
     return {"messages": tool_messages, "cart": cart, "order_total": order_total, "requires_handoff": requires_handoff}
 
 
+def execute_tools(state: AgentState):
+    results = [TOOL_HANDLERS.get(tc["name"], handle_unknown_tool)(tc) for tc in state["messages"][-1].tool_calls]
+    return fold_tool_results(state, results)
+
+
+async def run_tool(tool_call):
+    result = TOOL_HANDLERS.get(tool_call["name"], handle_unknown_tool)(tool_call)
+    # Handlers that do I/O (e.g. a POS submission) can be async def; they only run on the server's async path
+    return await result if inspect.isawaitable(result) else result
+
+
+async def aexecute_tools(state: AgentState):
+    results = await asyncio.gather(*(run_tool(tc) for tc in state["messages"][-1].tool_calls))
+    return fold_tool_results(state, results)
+
+
 def router(state: AgentState):
     if state["messages"][-1].tool_calls:
         return "execute_tools"
     return END
 
 
+def tools_router(state: AgentState):
+    # execute_tools already answered with a templated AIMessage; otherwise let Gemini read the tool results
+    if isinstance(state["messages"][-1], AIMessage):
+        return END
+    return "agent"
+
+
 workflow = StateGraph(AgentState)
-workflow.add_node("agent", call_model)
-workflow.add_node("execute_tools", execute_tools)
+# The server and the CLI simulator both run the graph asynchronously; the sync functions only serve plain invoke() callers
+workflow.add_node("agent", RunnableLambda(call_model, afunc=acall_model))
+workflow.add_node("execute_tools", RunnableLambda(execute_tools, afunc=aexecute_tools))
 workflow.add_edge(START, "agent")
 workflow.add_conditional_edges("agent", router)
-workflow.add_edge("execute_tools", "agent")
+workflow.add_conditional_edges("execute_tools", tools_router)
+
+# Call state lives in-process by default; set REDIS_URL to share it across uvicorn workers
+REDIS_URL = os.getenv("REDIS_URL")
+if REDIS_URL:
+    from langgraph.checkpoint.redis.aio import AsyncRedisSaver
+
+    # Abandoned calls expire after 30 minutes instead of piling up; active calls refresh the TTL on every turn
+    checkpointer = AsyncRedisSaver(redis_url=REDIS_URL, ttl={"default_ttl": 30, "refresh_on_read": True})
+else:
+    checkpointer = MemorySaver()
+
+
+async def setup_checkpointer():
+    """Creates the Redis indices. Must run inside the server's event loop before the first call."""
+    if REDIS_URL:
+        await checkpointer.asetup()
+
+
+async def end_call(thread_id: str):
+    """Drops a finished call's checkpoints so MemorySaver doesn't keep every call for the life of the worker."""
+    await checkpointer.adelete_thread(thread_id)
+
+
+async def warm_up():
+    """Opens the connection to Gemini before the caller's first turn needs it. A model lookup costs no tokens."""
+    try:
+        await llm.async_client.models.get(model=llm.model)
+    except Exception as e:
+        # Only a head start; the first real turn simply opens the connection itself
+        logger.warning("Gemini warmup failed: %s", e)
+
 
 # EXPORT THIS FOR MAIN.PY TO USE
-app_graph = workflow.compile(checkpointer=MemorySaver())
\ No newline at end of file
+app_graph = workflow.compile(checkpointer=checkpointer)
\ No newline at end of file
@@ -1,5 +1,7 @@
 import os
+import atexit
 from twilio.rest import Client
+from twilio.http.http_client import TwilioHttpClient
 from dotenv import load_dotenv
 
 # Load the variables from the .env file into the environment
@@ -12,17 +14,23 @@ twilio_number = os.getenv("TWILIO_NUMBER")
 your_mobile_number = os.getenv("MY_MOBILE_NUMBER")
 ngrok_url = os.getenv("NGROK_URL")
 
-# Initialize the Twilio Client
-client = Client(account_sid, auth_token)
+# Initialize the Twilio Client once on a pooled HTTP session, so repeated calls reuse the TLS connection to api.twilio.com
+http_client = TwilioHttpClient(pool_connections=True)
+atexit.register(http_client.session.close)
+client = Client(account_sid, auth_token, http_client=http_client)
 
-print(f"Calling {your_mobile_number}...")
 
-# Initiate the call
-call = client.calls.create(
-    to=your_mobile_number,
-    from_=twilio_number,
-    url=ngrok_url,
-    method="POST"
-)
+def place_call(to_number: str):
+    print(f"Calling {to_number}...")
+    call = client.calls.create(
+        to=to_number,
+        from_=twilio_number,
+        url=ngrok_url,
+        method="POST"
+    )
+    print(f"Call initiated! SID: {call.sid}")
+    return call
+
 
-print(f"Call initiated! SID: {call.sid}")
\ No newline at end of file
+# Initiate the call
+place_call(your_mobile_number)
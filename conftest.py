@@ -0,0 +1,9 @@
+import os
+
+# agent.py builds its Gemini clients on import; none of the tests reach the network, so any key will do
+os.environ.setdefault("GOOGLE_API_KEY", "test-key")
+# agent.py reads menu.json from the working directory, like the server does
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+# The terminal simulator, not a test module
+collect_ignore = ["test_bot.py"]
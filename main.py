@@ -1,62 +1,171 @@
 import os
-import json
+import re
+import orjson
 import base64
 import asyncio
+import logging
+import logging.handlers
+import queue
 import httpx
+from contextlib import asynccontextmanager, contextmanager
+from functools import lru_cache
 import websockets
-from dotenv import load_dotenv
 from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.responses import Response
 from twilio.twiml.voice_response import VoiceResponse
 from twilio.rest import Client
-from langchain_core.messages import HumanMessage, SystemMessage
+from twilio.http.async_http_client import AsyncTwilioHttpClient
+from langchain_core.messages import AIMessage, HumanMessage
 
 # --- IMPORT THE BRAIN FROM AGENT.PY ---
-from agent import app_graph, SYSTEM_PROMPT
-
-load_dotenv()
+# agent.py loads .env on import, so the keys below are already in the environment
+from agent import app_graph, SYSTEM_PROMPT, setup_checkpointer, end_call, warm_up
+
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+
+
+@contextmanager
+def setup_logging():
+    """Hands log records to a queue that a background thread writes to stderr, so a slow log driver never stalls
+    the event loop that is pumping audio. Installed only for the life of the server or simulator."""
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    root = logging.getLogger()
+    root.addHandler(queue_handler)
+    listener.start()
+    try:
+        yield
+    finally:
+        listener.stop()
+        root.removeHandler(queue_handler)
 
 
 # --- 1. EXTERNAL API HELPERS (The Mouth) ---
-async def generate_tts(text: str) -> str:
-    # FIX APPLIED: Guard clause to prevent crashing on empty tool outputs
-    if not text or not str(text).strip():
-        return ""
+# A sentence is ready to speak once its closing punctuation is followed by whitespace
+SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# Asking for staff outright is common enough, and urgent enough, to be worth bridging without a Gemini round-trip
+HANDOFF_RE = re.compile(
+    r"\b(manager|human|real person|representative|speak to (a |someone)|complaint|supervisor)\b", re.IGNORECASE)
+
+
+def extract_text(content) -> str:
+    """Gemini returns either a plain string or a list of content blocks; keep only the text."""
+    # Called for every streamed chunk, and nearly all of them are plain strings
+    if type(content) is str:
+        return content
+    return " ".join(block["text"] for block in content if block.get("type") == "text")
+
+
+# 1600 bytes of mu-law 8000Hz is 200ms of speech per Twilio media frame
+TTS_CHUNK_BYTES = 1600
+
+# One pooled client for every call, so each utterance reuses the open HTTP/2 connection to ElevenLabs
+# instead of paying DNS + TCP + TLS again. Closed in lifespan() on shutdown.
+TTS_CLIENT = httpx.AsyncClient(http2=True, timeout=10.0, limits=httpx.Limits(max_keepalive_connections=8))
+
+
+GREETING = "Welcome to DineLine Pizza! What would you like to order today?"
+
+# Phrases spoken on most calls are synthesized once at startup: text -> base64 media payloads.
+# "Anything else?" closes every templated add-to-cart reply and is split off as its own sentence.
+CACHED_PHRASES = [GREETING, "Anything else?"]
+TTS_CACHE = {}
 
-    """Takes text, calls ElevenLabs, returns Base64 encoded mu-law 8000Hz audio for Twilio."""
+
+async def tts_frames(text: str):
+    """Yields Base64 mu-law 8000Hz payloads from ElevenLabs as they are synthesized."""
     voice_id = os.getenv("ELEVENLABS_VOICE_ID", "pNInz6obpgDQGcFmaJcg")
-    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}?output_format=ulaw_8000"
+    url = f"https://api.elevenlabs.io/v1/text-to-speech/{voice_id}/stream?output_format=ulaw_8000"
     headers = {"xi-api-key": os.getenv("ELEVENLABS_API_KEY")}
     payload = {"text": str(text), "model_id": "eleven_turbo_v2_5"}
 
-    async with httpx.AsyncClient() as client:
-        response = await client.post(url, json=payload, headers=headers)
+    async with TTS_CLIENT.stream("POST", url, json=payload, headers=headers) as response:
         response.raise_for_status()  # Fail safely if ElevenLabs is down
-        return base64.b64encode(response.content).decode('utf-8')
+        async for chunk in response.aiter_bytes(TTS_CHUNK_BYTES):
+            yield base64.b64encode(chunk).decode('utf-8')
+
+
+async def prerender_tts(text: str):
+    try:
+        TTS_CACHE[text] = [frame async for frame in tts_frames(text)]
+    except httpx.HTTPError as e:
+        # Not fatal: stream_tts falls back to live synthesis for anything missing from the cache
+        logger.warning("TTS prerender failed for %r: %s", text, e)
+
+
+async def stream_tts(text: str, websocket: WebSocket, stream_sid: str):
+    """Sends speech to Twilio, from the startup cache if possible, otherwise streamed as it is synthesized."""
+    if not text or not str(text).strip():
+        return
+
+    # Base64 and the stream SID never need escaping, so each 200ms frame is spliced into a fixed template
+    # instead of building and serializing a dict per frame. Twilio only accepts text frames.
+    frame_prefix = f'{{"event":"media","streamSid":"{stream_sid}","media":{{"payload":"'
+
+    async def send(audio_payload: str):
+        await websocket.send_text(frame_prefix + audio_payload + '"}}')
+
+    cached = TTS_CACHE.get(text)
+    if cached:
+        for audio_payload in cached:
+            await send(audio_payload)
+        return
+
+    async for audio_payload in tts_frames(text):
+        await send(audio_payload)
 
 
 # --- 2. FASTAPI & WEBSOCKET SERVER ---
-app = FastAPI()
-twilio_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"))
+# Async Twilio client, so the handoff's REST call runs on the event loop instead of a worker thread.
+# Created in lifespan() because its aiohttp session needs the running loop.
+twilio_client = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global twilio_client
+    with setup_logging():
+        twilio_client = Client(os.getenv("TWILIO_ACCOUNT_SID"), os.getenv("TWILIO_AUTH_TOKEN"),
+                               http_client=AsyncTwilioHttpClient())
+        await setup_checkpointer()
+        await asyncio.gather(*(prerender_tts(text) for text in CACHED_PHRASES))
+        yield
+        await TTS_CLIENT.aclose()
+        await twilio_client.http_client.close()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@lru_cache(maxsize=8)
+def stream_twiml(host: str) -> str:
+    """The TwiML only depends on the public host, so it is serialized once per host instead of on every call."""
+    resp = VoiceResponse()
+    resp.connect().stream(url=f"wss://{host}/stream")
+    return str(resp)
 
 
 @app.post("/voice")
 async def voice_handler(request: Request):
-    resp = VoiceResponse()
     host = request.url.hostname
-    wss_url = f"wss://{host}/stream"
-
-    print(f"Incoming call. Connecting to Media Stream at: {wss_url}")
-    resp.connect().stream(url=wss_url)
-    return Response(content=str(resp), media_type="application/xml")
+    logger.info("Incoming call. Connecting to Media Stream at: wss://%s/stream", host)
+    return Response(content=stream_twiml(host), media_type="application/xml")
 
 
 @app.websocket("/stream")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    # Runs alongside the greeting, so the handshake with Gemini is done before the caller finishes speaking
+    warmup = asyncio.create_task(warm_up())
 
-    # Connect to Deepgram (The Ears) with endpointing set to 500ms
-    deepgram_url = "wss://api.deepgram.com/v1/listen?encoding=mulaw&sample_rate=8000&channels=1&endpointing=500"
+    # Connect to Deepgram (The Ears). A turn ends after 300ms of silence (speech_final); UtteranceEnd is the
+    # fallback for noisy lines where the VAD never sees silence, and needs interim results switched on.
+    deepgram_url = ("wss://api.deepgram.com/v1/listen?model=nova-2&encoding=mulaw&sample_rate=8000&channels=1"
+                    "&interim_results=true&utterance_end_ms=1000&vad_events=true&endpointing=300&smart_format=true")
 
     try:
         async with websockets.connect(
@@ -68,30 +177,40 @@ async def websocket_endpoint(websocket: WebSocket):
             stream_sid = None
             config = None
 
+            # STT -> LLM -> TTS run as separate tasks joined by queues, so Deepgram keeps being read and Gemini keeps
+            # generating while earlier sentences are still being synthesized and sent. None shuts a stage down.
+            transcript_q = asyncio.Queue()
+            speech_q = asyncio.Queue()
+
             async def listen_to_twilio():
                 nonlocal call_sid, stream_sid, config
                 try:
                     while True:
                         data = await websocket.receive_text()
-                        message = json.loads(data)
+
+                        # Media frames arrive 50 times a second; pull the payload out by hand instead of parsing
+                        # the whole message. Anything unexpected falls through to the full parse below.
+                        if '"event":"media"' in data:
+                            _, found, rest = data.partition('"payload":"')
+                            if found:
+                                await deepgram_ws.send(base64.b64decode(rest.partition('"')[0]))
+                                continue
+
+                        message = orjson.loads(data)
 
                         if message["event"] == "start":
                             stream_sid = message["start"]["streamSid"]
                             call_sid = message["start"]["callSid"]
                             config = {"configurable": {"thread_id": call_sid}}
 
-                            await app_graph.ainvoke(
-                                {"messages": [SystemMessage(content=SYSTEM_PROMPT)], "cart": [], "order_total": 0.0,
-                                 "requires_handoff": False}, config=config)
-                            greeting = "Welcome to DineLine Pizza! What would you like to order today?"
-                            await app_graph.ainvoke({"messages": [{"role": "assistant", "content": greeting}]},
-                                                    config=config)
+                            # The greeting is a constant, so seed the checkpoint directly instead of running the
+                            # graph (and paying a Gemini round-trip) just to record it. call_model adds the system prompt.
+                            await app_graph.aupdate_state(
+                                config, {"messages": [AIMessage(content=GREETING)], "cart": [], "order_total": 0.0,
+                                         "requires_handoff": False})
 
-                            print(f"AI: {greeting}")
-                            audio_payload = await generate_tts(greeting)
-                            if audio_payload:
-                                await websocket.send_text(json.dumps(
-                                    {"event": "media", "streamSid": stream_sid, "media": {"payload": audio_payload}}))
+                            logger.info("AI: %s", GREETING)
+                            speech_q.put_nowait(GREETING)
 
                         elif message["event"] == "media":
                             audio_bytes = base64.b64decode(message["media"]["payload"])
@@ -102,53 +221,118 @@ async def websocket_endpoint(websocket: WebSocket):
                             await deepgram_ws.close()
                             break
                 except Exception as e:
-                    print(f"Twilio Listen Error: {e}")
+                    logger.error("Twilio Listen Error: %s", e)
 
             async def listen_to_deepgram():
+                # Finalized pieces of the current turn; a long sentence can be finalized in several segments
+                utterance = []
+
+                def end_turn():
+                    if utterance:
+                        user_speech = " ".join(utterance)
+                        utterance.clear()
+                        logger.info("User said: %s", user_speech)
+                        transcript_q.put_nowait(user_speech)
+
                 try:
                     while True:
                         dg_response = await deepgram_ws.recv()
-                        result = json.loads(dg_response)
-
-                        if result.get("is_final") and result.get("speech_final") and \
-                                result.get("channel", {}).get("alternatives", [{}])[0].get("transcript"):
-                            user_speech = result["channel"]["alternatives"][0]["transcript"]
-                            print(f"User said: {user_speech}")
+                        result = orjson.loads(dg_response)
 
-                            events = await app_graph.ainvoke({"messages": [HumanMessage(content=user_speech)]},
-                                                             config=config)
+                        if result.get("type") == "UtteranceEnd":
+                            end_turn()
+                        elif result.get("is_final"):
+                            transcript = result.get("channel", {}).get("alternatives", [{}])[0].get("transcript")
+                            if transcript:
+                                utterance.append(transcript)
+                            if result.get("speech_final"):
+                                end_turn()
 
-                            # Parse out list responses if Gemini returns tool blocks
-                            raw_content = events["messages"][-1].content
-                            if isinstance(raw_content, list):
-                                ai_response = " ".join(
-                                    [block["text"] for block in raw_content if block.get("type") == "text"])
-                            else:
-                                ai_response = raw_content
+                except Exception as e:
+                    logger.error("Deepgram Listen Error: %s", e)
+                finally:
+                    transcript_q.put_nowait(None)
 
-                            requires_handoff = events.get("requires_handoff", False)
+            async def hand_off():
+                staff_number = os.getenv("STAFF_PHONE_NUMBER")
+                logger.info("Handoff Triggered. Bridging call to: %s", staff_number)
+                twiml_handoff = f'<Response><Say>Connecting you to staff.</Say><Dial>{staff_number}</Dial></Response>'
 
-                            print(f"AI replied: {ai_response}")
+                await twilio_client.calls(call_sid).update_async(twiml=twiml_handoff)
 
-                            if requires_handoff:
-                                staff_number = os.getenv("STAFF_PHONE_NUMBER")
-                                print(f"Handoff Triggered. Bridging call to: {staff_number}")
-                                twiml_handoff = f'<Response><Say>Connecting you to staff.</Say><Dial>{staff_number}</Dial></Response>'
+            async def llm_worker():
+                try:
+                    # One turn at a time: concurrent graph runs on the same thread_id would race on the checkpoint
+                    while (user_speech := await transcript_q.get()) is not None:
+                        # Explicit requests for staff skip Gemini; the request_human_handoff tool catches paraphrases
+                        if HANDOFF_RE.search(user_speech):
+                            await hand_off()
+                            break
 
-                                await asyncio.to_thread(twilio_client.calls(call_sid).update, twiml=twiml_handoff)
-                                break
+                        # Stream the graph so each finished sentence is queued for TTS while Gemini is still generating
+                        requires_handoff = False
+                        spoken = []
+                        pending = ""
+                        async for mode, data in app_graph.astream(
+                                {"messages": [HumanMessage(content=user_speech)]}, config=config,
+                                stream_mode=["messages", "updates"]):
+                            if mode == "updates":
+                                if (data.get("execute_tools") or {}).get("requires_handoff"):
+                                    requires_handoff = True
+                                continue
+
+                            chunk, metadata = data
+                            # Nothing more is spoken once the call is being bridged to staff: hand_off's TwiML says
+                            # "Connecting you to staff." itself. execute_tools streams its templated reply before its
+                            # update arrives, so the handoff is caught from the agent's tool call instead.
+                            if requires_handoff or not isinstance(chunk, AIMessage):
+                                continue
+                            tool_calls = getattr(chunk, "tool_call_chunks", None) or getattr(chunk, "tool_calls", None)
+                            if tool_calls:
+                                # Tool-calling turn: hold back any preamble, the real reply comes after the tools
+                                pending = ""
+                                requires_handoff = any(call.get("name") == "request_human_handoff" for call in tool_calls)
+                                continue
+
+                            pending += extract_text(chunk.content)
+                            *sentences, pending = SENTENCE_END.split(pending)
+                            for sentence in sentences:
+                                spoken.append(sentence)
+                                speech_q.put_nowait(sentence)
+
+                        ai_response = " ".join(spoken + [pending]).strip()
+                        logger.info("AI replied: %s", ai_response)
+
+                        if requires_handoff:
+                            await hand_off()
+                            break
 
-                            audio_payload = await generate_tts(ai_response)
-                            if audio_payload:
-                                await websocket.send_text(json.dumps(
-                                    {"event": "media", "streamSid": stream_sid, "media": {"payload": audio_payload}}))
+                        speech_q.put_nowait(pending)
 
                 except Exception as e:
-                    print(f"Deepgram Listen Error: {e}")
-
-            await asyncio.gather(listen_to_twilio(), listen_to_deepgram())
+                    logger.exception("LLM Worker Error: %s", e)
+                finally:
+                    speech_q.put_nowait(None)
+
+            async def tts_worker():
+                while (text := await speech_q.get()) is not None:
+                    try:
+                        await stream_tts(text, websocket, stream_sid)
+                    except Exception as e:
+                        # One failed sentence should not silence the rest of the call
+                        logger.exception("TTS Worker Error: %s", e)
+
+            try:
+                await asyncio.gather(listen_to_twilio(), listen_to_deepgram(), llm_worker(), tts_worker())
+            finally:
+                # The call is over (hung up or bridged to staff); nothing reads its state again
+                if call_sid:
+                    await end_call(call_sid)
 
     except WebSocketDisconnect:
-        print("WebSocket disconnected naturally.")
+        logger.info("WebSocket disconnected naturally.")
     except Exception as e:
-        print(f"WebSocket Error: {e}")
\ No newline at end of file
+        logger.error("WebSocket Error: %s", e)
+    finally:
+        # A call that drops within the first second would otherwise leave the lookup running past the handler
+        warmup.cancel()
\ No newline at end of file
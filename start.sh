@@ -0,0 +1,13 @@
+#!/usr/bin/env bash
+# Production launcher for the voice server. Each call lives on a single WebSocket, so it stays on one worker;
+# set REDIS_URL anyway if you want call state to survive a worker restart.
+# Needs uvloop and httptools: pip install "uvicorn[standard]"
+set -euo pipefail
+
+exec uvicorn main:app \
+    --host 0.0.0.0 \
+    --port "${PORT:-8000}" \
+    --workers "${WEB_CONCURRENCY:-$(nproc)}" \
+    --loop uvloop \
+    --http httptools \
+    --no-access-log
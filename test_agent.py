@@ -0,0 +1,119 @@
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage, ToolMessage
+
+from agent import (HISTORY_TRIM_STEP, HISTORY_WINDOW, MENU_ITEMS, SYSTEM_MESSAGE, build_prompt, find_menu_items,
+                   fold_tool_results, handle_add_to_cart, handle_handoff, handle_search_menu)
+from test_bot import read_trace, write_trace
+
+
+def names(indices: list) -> list:
+    return [MENU_ITEMS[idx]["name"] for idx in indices]
+
+
+def tool_turn(*calls: tuple, cart: list = None, order_total: float = 0.0) -> tuple:
+    """State after Gemini asked for `calls`, plus what the handlers returned for them."""
+    tool_calls = [{"name": name, "args": args, "id": f"call-{i}"} for i, (name, args) in enumerate(calls)]
+    state = {"messages": [HumanMessage(content="hi"), AIMessage(content="", tool_calls=tool_calls)],
+             "cart": cart or [], "order_total": order_total, "requires_handoff": False}
+    handlers = {"add_to_cart": handle_add_to_cart, "request_human_handoff": handle_handoff,
+                "search_menu": handle_search_menu}
+    return state, [handlers[tc["name"]](tc) for tc in tool_calls]
+
+
+def test_find_menu_items_matches_word_prefixes():
+    assert "Pepperoni Pizza" in names(find_menu_items("pep"))
+
+
+def test_find_menu_items_requires_every_word():
+    assert names(find_menu_items("pepperoni pizza")) == ["Pepperoni Pizza"]
+
+
+def test_find_menu_items_empty_query():
+    assert find_menu_items("") == []
+
+
+def test_fold_add_to_cart_answers_from_template():
+    state, results = tool_turn(("add_to_cart", {"variant_id": "pep_small", "quantity": 2}))
+    update = fold_tool_results(state, results)
+
+    assert update["order_total"] == 20.0
+    assert [line["quantity"] for line in update["cart"]] == [2]
+    assert update["messages"][-1].content == \
+        "Added 2 Pepperoni Pizza - Small (10 inch). Your total is $20.00. Anything else?"
+    assert not update["requires_handoff"]
+
+
+def test_fold_handoff_answers_from_template():
+    state, results = tool_turn(("request_human_handoff", {"reason": "asked for a manager"}))
+    update = fold_tool_results(state, results)
+
+    assert update["requires_handoff"]
+    assert update["messages"][-1].content == "Connecting you to staff."
+
+
+def test_fold_mixed_tools_leave_the_reply_to_gemini():
+    state, results = tool_turn(("search_menu", {"query": "coke"}),
+                               ("add_to_cart", {"variant_id": "pep_small", "quantity": 1}))
+    update = fold_tool_results(state, results)
+
+    assert all(isinstance(m, ToolMessage) for m in update["messages"])
+    assert update["order_total"] == 10.0
+
+
+def test_fold_failed_add_leaves_the_reply_to_gemini():
+    cart = [{"variant_id": "pep_small", "name": "Pepperoni Pizza - Small (10 inch)", "quantity": 1,
+             "unit_price": 10.0, "line_total": 10.0}]
+    state, results = tool_turn(("add_to_cart", {"variant_id": "no_such_pizza", "quantity": 1}),
+                               cart=cart, order_total=10.0)
+    update = fold_tool_results(state, results)
+
+    assert [m.status for m in update["messages"]] == ["error"]
+    assert update["cart"] == cart
+    assert update["order_total"] == 10.0
+
+
+def conversation(turns: int) -> list:
+    return [HumanMessage(content=f"turn {i}") if i % 2 == 0 else AIMessage(content=f"reply {i}")
+            for i in range(turns)]
+
+
+def prompt_history(messages: list) -> list:
+    return build_prompt({"messages": messages, "cart": [], "order_total": 0.0})[2:]
+
+
+def test_build_prompt_puts_the_cart_after_the_system_prompt():
+    prompt = build_prompt({"messages": conversation(2), "cart": [], "order_total": 0.0})
+
+    assert prompt[0] is SYSTEM_MESSAGE
+    assert isinstance(prompt[1], SystemMessage) and prompt[1].content == "Cart: empty. Total $0.00."
+
+
+def test_build_prompt_trims_in_blocks_past_the_window():
+    # Up to a full trim step over the window the history is sent whole, so the cached prefix stays put
+    messages = conversation(HISTORY_WINDOW + HISTORY_TRIM_STEP - 1)
+    assert prompt_history(messages) == messages
+
+    messages = conversation(HISTORY_WINDOW + HISTORY_TRIM_STEP)
+    assert prompt_history(messages) == messages[-HISTORY_WINDOW:]
+
+
+def test_build_prompt_window_starts_on_a_customer_turn():
+    messages = conversation(HISTORY_WINDOW + HISTORY_TRIM_STEP)
+    messages[HISTORY_TRIM_STEP] = ToolMessage(content="System: Handoff initiated.", tool_call_id="call-0")
+
+    history = prompt_history(messages)
+    assert isinstance(history[0], HumanMessage)
+    assert history == messages[-len(history):]
+
+
+def test_trace_round_trip(tmp_path):
+    path = tmp_path / "trace.bin"
+    values = {"cart": [{"variant_id": "pep_small", "quantity": 2}], "order_total": 20.0, "requires_handoff": False}
+    with open(path, "wb") as trace:
+        write_trace(trace, 1, "hello", {}, 12.5)
+        write_trace(trace, 2, "Added 2 Pepperoni Pizza", values, 3.0)
+
+    assert list(read_trace(str(path))) == [
+        {"turn": 1, "reply": "hello", "cart": [], "total": 0.0, "handoff": False, "ms": 12.5},
+        {"turn": 2, "reply": "Added 2 Pepperoni Pizza", "cart": values["cart"], "total": 20.0, "handoff": False,
+         "ms": 3.0},
+    ]
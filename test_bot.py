@@ -1,75 +1,372 @@
+import os
+import sys
+import time
 import uuid
-from langchain_core.messages import HumanMessage
+import itertools
+import asyncio
+import logging
+import struct
+import argparse
+import orjson
+import ormsgpack
+import aiohttp
+import httpx
+from google.genai.errors import APIError
+from langchain_core.exceptions import LangChainException
+from langchain_google_genai.chat_models import ChatGoogleGenerativeAIError
+from langchain_core.messages import AIMessage, HumanMessage
 # IMPORT the graph and greeting directly from your main application!
-from main import app_graph, SYSTEM_PROMPT
+from main import app_graph, SYSTEM_PROMPT, GREETING, extract_text, setup_checkpointer, setup_logging, warm_up
 
+logger = logging.getLogger("dineline.cli")
 
-def run_cli():
+STDOUT_IS_TTY = sys.stdout.isatty()
+
+# What a turn can fail with once the SDK has used up its own retries: LangChain's classified model errors (rate limits,
+# auth, bad requests), the wrappers the Google client raises outside that hierarchy, and network failures from either
+# transport (aiohttp for async calls, httpx for sync). Anything else is a bug and should stop the simulator.
+TURN_ERRORS = (LangChainException, ChatGoogleGenerativeAIError, APIError, aiohttp.ClientError, httpx.TransportError,
+               TimeoutError)
+
+EXIT_WORDS = frozenset(("quit", "exit"))
+EXIT_WORD_MAX_LEN = max(map(len, EXIT_WORDS))
+
+
+def is_exit(user_input: str) -> bool:
+    # Length first, so long pasted turns are never lowercased just to be compared with a four-letter word
+    return len(user_input) <= EXIT_WORD_MAX_LEN and user_input.lower() in EXIT_WORDS
+
+
+async def read_turns():
+    """Yields the user's lines, stripped: input() on a terminal, plain readline() when a script is piped in (no prompt,
+    no flushes)."""
+    if sys.stdin.isatty():
+        # input() blocks the event loop, so background tasks stall while the user types; run_cli finishes the
+        # Gemini warmup before the first prompt for that reason
+        while True:
+            try:
+                yield input("\nYou: ").strip()
+            except EOFError:
+                return
+    else:
+        # Prefetch: the next line is read in a worker thread while the current turn is still streaming
+        next_line = asyncio.create_task(asyncio.to_thread(sys.stdin.readline))
+        while line := await next_line:
+            next_line = asyncio.create_task(asyncio.to_thread(sys.stdin.readline))
+            yield line.strip()
+
+
+# Every session starts from the same state: the greeting already spoken and an empty cart
+FIRST_TURN_TEMPLATE = {
+    "messages": [{"role": "assistant", "content": GREETING}],
+    "cart": [],
+    "order_total": 0.0,
+    "requires_handoff": False
+}
+
+
+# (session, normalized input, cart) -> reply, for --cache. Only replies that left the cart and handoff untouched are
+# stored, so replaying one never skips a tool call that would have changed the order.
+REPLY_CACHE = {}
+
+
+def reply_cache_key(session_id: str, user_input: str, cart: list) -> tuple:
+    return session_id, " ".join(user_input.lower().split()), tuple((line["variant_id"], line["quantity"]) for line in cart)
+
+
+# Sessions are numbered instead of drawing a uuid4 from os.urandom each time. The pid and start time keep two runs
+# apart when they share a Redis checkpointer. --uuid switches back to globally unique ids for distributed logging.
+SESSION_PREFIX = f"{os.getpid()}-{time.time_ns()}"
+SESSION_COUNTER = itertools.count(1)
+USE_UUID = False
+
+
+def new_session_id() -> str:
+    if USE_UUID:
+        return str(uuid.uuid4())
+    return f"{SESSION_PREFIX}-{next(SESSION_COUNTER)}"
+
+
+def make_config(session_id: str) -> dict:
+    return {"configurable": {"thread_id": session_id}}
+
+
+def first_turn_input(user_input: str) -> dict:
+    return {**FIRST_TURN_TEMPLATE, "messages": [*FIRST_TURN_TEMPLATE["messages"], {"role": "user", "content": user_input}]}
+
+
+def print_turn(user_input: str, events: dict):
+    # One write per turn; Gemini may return a list of content blocks instead of a plain string
+    sys.stdout.write(f"\nYou: {user_input}\nAI: {extract_text(events['messages'][-1].content)}\n")
+    print_state(events)
+
+
+def print_state(values: dict):
+    # Only shown with -v, as one JSON object per turn so scripted runs can be grepped or parsed afterwards
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("\n[DEBUG STATE] -> %s", orjson.dumps({
+            "cart": values.get("cart", []),
+            "total": values.get("order_total", 0.0),
+            "handoff": values.get("requires_handoff", False)
+        }).decode())
+
+
+async def stream_turn(input_data: dict, config: dict) -> dict:
+    """Prints the reply as Gemini generates it and returns the state the turn ended in."""
+    write = sys.stdout.write
+    write("AI: ")
+    async for chunk, metadata in app_graph.astream(input_data, config=config, stream_mode="messages"):
+        # Tool messages and tool-call chunks are the graph's plumbing, not part of the reply
+        if isinstance(chunk, AIMessage) and not chunk.tool_calls and not getattr(chunk, "tool_call_chunks", None):
+            write(extract_text(chunk.content))
+            # Only a person watching needs each chunk right away; piped output is left to block buffering
+            if STDOUT_IS_TTY:
+                sys.stdout.flush()
+    write("\n")
+
+    # The stream only carries messages; cart and handoff come from the checkpoint
+    return (await app_graph.aget_state(config)).values
+
+
+# Each --trace-binary frame is a little-endian uint32 length followed by that many bytes of msgpack, so the file can
+# be read back with ormsgpack.unpackb alone (it has no streaming unpacker)
+TRACE_LEN = struct.Struct("<I")
+
+
+def write_trace(trace, turn: int, reply: str, values: dict, ms: float):
+    frame = ormsgpack.packb({
+        "turn": turn,
+        "reply": reply,
+        "cart": values.get("cart", []),
+        "total": values.get("order_total", 0.0),
+        "handoff": values.get("requires_handoff", False),
+        "ms": ms
+    })
+    trace.write(TRACE_LEN.pack(len(frame)) + frame)
+
+
+def read_trace(path: str):
+    """Yields the turns written by --trace-binary, for scripts that analyse a run."""
+    with open(path, "rb") as trace:
+        while header := trace.read(TRACE_LEN.size):
+            (length,) = TRACE_LEN.unpack(header)
+            yield ormsgpack.unpackb(trace.read(length))
+
+
+# Longest the interactive simulator holds the first prompt for the Gemini warmup (seconds)
+WARMUP_TIMEOUT = 3.0
+
+
+async def timed_warm_up():
+    start = time.perf_counter()
+    await warm_up()
+    logger.debug("Gemini warmup took %.0f ms", (time.perf_counter() - start) * 1000)
+
+
+async def run_batch(batch_size: int, trace=None):
+    """Regression mode for piped input: every line is its own one-turn conversation, and `batch_size` of them are
+    sent through app_graph.abatch() at once so their Gemini round-trips overlap instead of running back to back."""
+    session_id = new_session_id()
+    turns = read_turns()
+    turn = 0
+    done = False
+
+    while not done:
+        chunk = []
+        while len(chunk) < batch_size:
+            line = await anext(turns, None)
+            if line is None or is_exit(line):
+                done = True
+                break
+            if line:
+                chunk.append(line)
+        if not chunk:
+            break
+
+        configs = [make_config(f"{session_id}-{turn + i}") for i in range(len(chunk))]
+        start = time.perf_counter()
+        results = await app_graph.abatch([first_turn_input(line) for line in chunk], config=configs,
+                                         return_exceptions=True)
+        # Lines in a batch run together, so each one is traced with the whole batch's latency
+        ms = (time.perf_counter() - start) * 1000
+
+        for i, (line, events) in enumerate(zip(chunk, results)):
+            if isinstance(events, Exception):
+                logger.error("\nYou: %s\nError occurred: %s", line, events, exc_info=events)
+            else:
+                print_turn(line, events)
+                if trace:
+                    write_trace(trace, turn + i + 1, extract_text(events["messages"][-1].content), events, ms)
+        turn += len(chunk)
+
+
+async def run_dialog(lines: list, session_id: str) -> str:
+    """Plays one scripted conversation to the end (or to a handoff) and returns its transcript."""
+    config = make_config(session_id)
+    await app_graph.aupdate_state(config, FIRST_TURN_TEMPLATE)
+    transcript = [f"AI: {GREETING}"]
+
+    for user_input in lines:
+        events = await app_graph.ainvoke({"messages": [{"role": "user", "content": user_input}]}, config=config)
+        transcript.append(f"You: {user_input}\nAI: {extract_text(events['messages'][-1].content)}")
+        if events.get("requires_handoff", False):
+            transcript.append("*** HUMAN HANDOFF INITIATED ***")
+            break
+
+    return "\n".join(transcript)
+
+
+async def run_parallel(max_dialogs: int):
+    """Regression mode for piped input: blank lines separate independent dialogs, and up to `max_dialogs` of them run
+    at once on their own thread_ids. Each transcript is printed whole when its dialog finishes."""
+    session_id = new_session_id()
+    dialogs = [[]]
+    async for line in read_turns():
+        if is_exit(line):
+            break
+        if line:
+            dialogs[-1].append(line)
+        elif dialogs[-1]:
+            dialogs.append([])
+
+    # The work is waiting on Gemini, so a semaphore on the event loop does what a thread pool would, without threads
+    limit = asyncio.Semaphore(max_dialogs)
+
+    async def run_one(index: int, lines: list):
+        async with limit:
+            try:
+                transcript = await run_dialog(lines, f"{session_id}-{index}")
+            except TURN_ERRORS as e:
+                logger.exception("\n=== Dialog %d ===\nError occurred: %s", index + 1, e)
+                return
+        sys.stdout.write(f"\n=== Dialog {index + 1} ===\n{transcript}\n")
+
+    await asyncio.gather(*(run_one(i, lines) for i, lines in enumerate(dialogs) if lines))
+
+
+async def run_cli(use_cache: bool = False, trace=None, warmup=None):
     print("==================================================")
     print("  DineLine AI - Local Terminal Testing Simulator  ")
     print("  Type 'quit' or 'exit' to stop the simulator.    ")
     print("==================================================\n")
 
-    session_id = str(uuid.uuid4())
-    config = {"configurable": {"thread_id": session_id}}
+    session_id = new_session_id()
+    config = make_config(session_id)
+
+    # Seed the session like the voice server does, so every turn below only sends the new user message
+    await app_graph.aupdate_state(config, FIRST_TURN_TEMPLATE)
+    print(f"AI: {GREETING}")
 
-    greeting = "Welcome to DineLine Pizza! What would you like to order today?"
-    print(f"AI: {greeting}")
+    # On a terminal the first input() would freeze the warmup task until Enter, so let it finish first.
+    # shield() keeps it running if it is slow; turn 1 then just shares the connection attempt.
+    if warmup and sys.stdin.isatty():
+        try:
+            await asyncio.wait_for(asyncio.shield(warmup), timeout=WARMUP_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
 
-    is_first_turn = True
+    turns = read_turns()
+    events = FIRST_TURN_TEMPLATE
+    turn = 0
 
     while True:
         try:
-            user_input = input("\nYou: ")
+            user_input = await anext(turns, None)
 
-            if user_input.lower() in ['quit', 'exit']:
+            if user_input is None or is_exit(user_input):
                 print("Exiting simulator...")
                 break
-            if not user_input.strip():
+            if not user_input:
                 continue
 
-            if is_first_turn:
-                input_data = {
-                    "messages": [
-                        {"role": "assistant", "content": greeting},
-                        {"role": "user", "content": user_input}
-                    ],
-                    "cart": [],
-                    "order_total": 0.0,
-                    "requires_handoff": False
-                }
-                is_first_turn = False
-            else:
-                input_data = {"messages": [{"role": "user", "content": user_input}]}
-
-            # Process through the LangGraph imported from main.py
-            events = app_graph.invoke(input_data, config=config)
+            turn += 1
+            start = time.perf_counter()
+            cart = events.get("cart", [])
+            cache_key = reply_cache_key(session_id, user_input, cart) if use_cache else None
+            if cache_key in REPLY_CACHE:
+                reply = REPLY_CACHE[cache_key]
+                print(f"AI: {reply}")
+                # Keep the history complete so later turns still see this exchange
+                await app_graph.aupdate_state(config, {"messages": [HumanMessage(content=user_input),
+                                                                    AIMessage(content=reply)]})
+                if trace:
+                    write_trace(trace, turn, reply, events, (time.perf_counter() - start) * 1000)
+                continue
 
-            # --- FIX: Parse the weird Gemini list output into clean text ---
-            raw_content = events["messages"][-1].content
-            if isinstance(raw_content, list):
-                # If Gemini returns a list of dictionaries, extract just the text
-                ai_response = " ".join([block["text"] for block in raw_content if block.get("type") == "text"])
-            else:
-                ai_response = raw_content
+            input_data = {"messages": [{"role": "user", "content": user_input}]}
 
-            cart = events.get("cart", [])
-            total = events.get("order_total", 0.0)
-            requires_handoff = events.get("requires_handoff", False)
+            # Process through the LangGraph imported from main.py
+            events = await stream_turn(input_data, config)
+            ms = (time.perf_counter() - start) * 1000
 
-            print(f"AI: {ai_response}")
-            print(f"\n[DEBUG STATE] -> Cart: {cart} | Total: ${total} | Handoff Triggered: {requires_handoff}")
+            reply = extract_text(events["messages"][-1].content)
+            if trace:
+                write_trace(trace, turn, reply, events, ms)
 
-            if requires_handoff:
+            # The session is over; the trace above already has the final state
+            if events.get("requires_handoff", False):
                 print("\n*** HUMAN HANDOFF INITIATED. SIMULATOR ENDING ***")
                 break
 
+            print_state(events)
+            if cache_key and events.get("cart", []) == cart:
+                REPLY_CACHE[cache_key] = reply
+
         except KeyboardInterrupt:
             print("\nExiting simulator...")
             break
-        except Exception as e:
-            print(f"\nError occurred: {e}")
+        except TURN_ERRORS as e:
+            logger.exception("\nError occurred: %s", e)
 
 
 if __name__ == "__main__":
-    run_cli()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="DineLine AI terminal simulator")
+    parser.add_argument("--batch", type=int, default=1,
+                        help="with piped input, run each line as its own conversation, N at a time")
+    parser.add_argument("--parallel", type=int, default=1,
+                        help="with piped input, run blank-line-separated dialogs as separate sessions, N at a time "
+                             "(not with --cache or --trace-binary)")
+    parser.add_argument("--cache", action="store_true",
+                        help="answer a repeated question with the same cart from memory instead of calling Gemini")
+    parser.add_argument("--trace-binary", metavar="PATH",
+                        help="also write each turn's reply, cart, total, handoff and latency to PATH as msgpack")
+    parser.add_argument("--uuid", action="store_true", help="use random uuid4 session ids instead of numbered ones")
+    parser.add_argument("-v", "--verbose", action="store_true", help="print the cart and handoff state after every turn")
+    args = parser.parse_args()
+    # Parallel dialogs only print transcripts; each runs in its own session, so it would never hit the reply cache,
+    # and interleaved turns from different dialogs would be ambiguous in a trace
+    if args.parallel > 1 and (args.cache or args.trace_binary):
+        parser.error("--parallel cannot be combined with --cache or --trace-binary")
+    USE_UUID = args.uuid
+
+    # Written straight to stdout so the debug state stays in order with the conversation
+    handler = logging.StreamHandler(sys.stdout)
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG if args.verbose else logging.INFO)
+
+    async def main():
+        # Same async graph path as the voice server, which also lets the Redis checkpointer work here
+        await setup_checkpointer()
+        # Opens the Gemini connection before turn 1: in the background for piped input, and before the first prompt
+        # on a terminal, where input() would otherwise block it
+        warmup = asyncio.create_task(timed_warm_up())
+        trace = open(args.trace_binary, "wb") if args.trace_binary else None
+        try:
+            if args.parallel > 1 and not sys.stdin.isatty():
+                await run_parallel(args.parallel)
+            elif args.batch > 1 and not sys.stdin.isatty():
+                await run_batch(args.batch, trace)
+            else:
+                await run_cli(args.cache, trace, warmup)
+        finally:
+            if trace:
+                trace.close()
+
+    # Library warnings go through the same log queue as on the voice server
+    with setup_logging():
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            # Ctrl+C during a turn cancels main() rather than reaching run_cli's handler around input()
+            print("\nExiting simulator...")
\ No newline at end of file